@@ -1,7 +1,16 @@
-import json
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
-
-from pydantic.error_wrappers import ValidationError
+from ipaddress import (
+    ip_address,
+    ip_network,
+    IPv4Address,
+    IPv6Address,
+    IPv4Network,
+    IPv6Network,
+)
+from socket import AF_INET, inet_pton
+from typing import Iterable, Union
 
 import internals
 import config
@@ -9,28 +18,42 @@ import models
 import services.aws
 
 
-def pre_process(contents: str, category: str) -> list[models.TalosIntelligence]:
+def extract_ip_address(line: str) -> Union[IPv4Address, IPv6Address, IPv4Network, IPv6Network, None]:
+    value = line.strip()
+    if not value or value.startswith('#'):
+        return None
+    if '/' not in value:
+        # fast path, dotted-quad parsed in C by inet_pton (strict, like ipaddress)
+        # ValueError on an embedded NUL, leave it to the fallback below
+        with contextlib.suppress(OSError, ValueError):
+            return IPv4Address(inet_pton(AF_INET, value))
+    try:
+        return ip_network(value, strict=False) if '/' in value else ip_address(value)
+    except ValueError:
+        internals.logger.warning(f"Invalid IP address {value}")
+    return None
+
+
+def pre_process(lines: Iterable[bytes], category: str) -> list[models.TalosIntelligence]:
     internals.logger.debug("pre_process")
     results = []
-    if not contents:
-        return results
-    for line in contents.splitlines():
-        if line.startswith('#'):
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    # filter comments and blanks on raw bytes, only decode candidate addresses
+    candidates = (line.strip() for line in lines)
+    for line in candidates:
+        if not line or line.startswith(b'#'):
             continue
-        ip_address = line.strip()
-        if not ip_address:
+        parsed = extract_ip_address(line.decode('ascii', errors='replace'))
+        if parsed is None:
             continue
-        try:
-            results.append(
-                models.TalosIntelligence(
-                    ip_address=ip_address.strip(),
-                    last_seen=datetime.now(timezone.utc),
-                    category=category,
-                )
+        # fields are already typed, skip pydantic validation
+        results.append(
+            models.TalosIntelligence.construct(
+                ip_address=parsed,
+                last_seen=now,
+                category=category,
             )
-        except ValidationError as err:
-            internals.logger.warning(err, exc_info=True)
-            internals.logger.warning(line)
+        )
     internals.logger.info(f"Parsed {len(results)} records")
 
     return results
@@ -41,22 +64,33 @@ def fetch(feed: models.FeedConfig) -> list[models.TalosIntelligence]:
     if feed.disabled:
         internals.logger.info(f"{feed.name} [magenta]disabled[/magenta]")
         return []
-    file_path = internals.download_file(feed.url)
-    if file_path.exists():
-        return pre_process(file_path.read_text(encoding='utf8'), feed.name)
-    return []
+    file_path, changed = internals.download_file(feed.url)
+    if not file_path or not file_path.exists():
+        return []
+    if not changed:
+        # the download cache is refreshed before processing, so only skip when
+        # a run has saved state after the cached copy was written
+        state = models.FeedState(source=feed.source, feed_name=feed.name).load()
+        if state and state.last_checked and state.last_checked.timestamp() >= file_path.stat().st_mtime:
+            internals.logger.info(f"{feed.name} unchanged since last run")
+            return []
+        internals.logger.warning(f"{feed.name} cached download was not processed, processing again")
+    with file_path.open('rb', buffering=1 << 16) as handle:
+        return pre_process(handle, feed.name)
 
 
 def process(feed: models.FeedConfig, feed_items: list[models.TalosIntelligence]) -> list[models.FeedStateItem]:
     state = models.FeedState(source=feed.source, feed_name=feed.name)
+    # feeds occasionally repeat an entry, index once by address
+    feed_index = {str(item.ip_address): item for item in feed_items}
     # step 0, initial ONLY block
     if not state.load():
         internals.logger.warning("process step 0 initial ONLY")
         state.url = feed.url
         state.records = {}
-        for item in feed_items:
-            state.records[str(item.ip_address)] = models.FeedStateItem(
-                key=str(item.ip_address),
+        for key, item in feed_index.items():
+            state.records[key] = models.FeedStateItem(
+                key=key,
                 data=item,
                 data_model='TalosIntelligence',
                 first_seen=item.last_seen,
@@ -67,59 +101,69 @@ def process(feed: models.FeedConfig, feed_items: list[models.TalosIntelligence])
 
     # step 1, exit any records that no longer appear in the feed
     internals.logger.info("process step 1 exit records")
-    feed_index = set()
-    for item in feed_items:
-        feed_index.add(str(item.ip_address))
-
-    for state_item in state.records.keys():
-        if state_item not in feed_index:
-            state.exit(state_item)
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    for state_item in state.records.keys() - feed_index.keys():
+        state.exit(state_item, now)
 
     # step 2, process new entrants
     entrants = []
     internals.logger.info("process step 2 process new entrants")
-    for feed_item in feed_items:
-        if item := state.records.get(str(feed_item.ip_address)):
+    for key, feed_item in feed_index.items():
+        if item := state.records.get(key):
             if item.current:
                 continue
             item.current = True
-            item.entrances.append(datetime.now(timezone.utc))
+            item.entrances.append(now)
         else:
             item = models.FeedStateItem(
-                key=str(feed_item.ip_address),
+                key=key,
                 data=feed_item,
                 data_model='TalosIntelligence',
-                first_seen=datetime.now(timezone.utc),
+                first_seen=now,
                 current=True,
-                entrances=[datetime.now(timezone.utc)],
+                entrances=[now],
                 exits=[],
             )
-        state.records[item.key] = item
+            state.records[key] = item
         entrants.append(item)
 
     # step 3, persist state
     internals.logger.info("process step 3 persist state")
+    # full precision, fetch compares it to the download cache mtime
     state.last_checked = datetime.now(timezone.utc)
     state.save()
     internals.logger.info(f"Detected {len(entrants)} new entrants")
     return entrants
 
 
-def handler(event, context):
-    start = datetime.now(timezone.utc)
-    for feed in config.feeds:
-        results = fetch(feed)
-        if not results:
-            continue
-        # services.aws.delete_s3(f"{internals.APP_ENV}/feeds/{feed.source}/{feed.name}/state.json")
-        services.aws.store_s3(
+def handle_feed(feed: models.FeedConfig, start: datetime, queue: services.aws.SqsBuffer):
+    results = fetch(feed)
+    if not results:
+        return
+    # services.aws.delete_s3(f"{internals.APP_ENV}/feeds/{feed.source}/{feed.name}/state.json")
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        # the snapshot is independent of state processing, upload it in the background
+        snapshot = executor.submit(
+            services.aws.store_s3,
             path_key=f"{internals.APP_ENV}/feeds/{feed.source}/{feed.name}/{start.strftime('%Y%m%d%H')}.json",
-            value=json.dumps(results, default=str)
+            value=internals.json_dumps(results)
         )
+        feed_data = feed.dict()
         for state_item in process(feed, results):
-            services.aws.store_sqs(
-                queue_name=f'{internals.APP_ENV.lower()}-early-warning-service',
-                message_body=json.dumps({**feed.dict(), **state_item.dict()}, cls=internals.JSONEncoder),
-                deduplicate=False,
-            )
-        internals.logger.debug(f"done {feed.name}")
+            queue.add(internals.json_dumps({**feed_data, **state_item.dict()}))
+        snapshot.result()
+    internals.logger.debug(f"done {feed.name}")
+
+
+def handler(event, context):
+    start = datetime.now(timezone.utc)
+    # messages from all feeds share SendMessageBatch requests
+    queue = services.aws.SqsBuffer(queue_name=f'{internals.APP_ENV.lower()}-early-warning-service')
+    try:
+        # feeds are I/O bound (HTTP download, S3, SQS) so overlap them
+        with ThreadPoolExecutor(max_workers=min(32, len(config.feeds)) or 1) as executor:
+            for future in [executor.submit(handle_feed, feed, start, queue) for feed in config.feeds]:
+                future.result()
+    finally:
+        queue.flush()
+        internals.logger.info(f"Queued {queue.queued} new entrants, {len(queue.failed)} failed")
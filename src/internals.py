@@ -5,23 +5,30 @@ import re
 import logging
 import hmac
 import hashlib
-import threading
 import json
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-import errno
-from os import path, getenv
+from os import path, getenv, remove, replace
 from socket import error as SocketError
-from typing import Union
+from typing import Any, Union
 from base64 import b64encode
-from datetime import datetime, timedelta, timezone
+from datetime import datetime, timezone
+from functools import cached_property
+from email.utils import formatdate
 from urllib.parse import urlparse
 from ipaddress import (
     IPv4Address,
     IPv6Address,
+    IPv4Network,
+    IPv6Network,
 )
 
 import boto3
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 from retry.api import retry
 from pydantic import (
     HttpUrl,
@@ -44,32 +51,34 @@ logger = logging.getLogger(__name__)
 if getenv("AWS_EXECUTION_ENV") is not None:
     boto3.set_stream_logger('boto3', getattr(logging, LOG_LEVEL, DEFAULT_LOG_LEVEL))
 logger.setLevel(getattr(logging, LOG_LEVEL, DEFAULT_LOG_LEVEL))
+# shared so keep-alive connections are reused across downloads and feeds
+_SESSION = requests.Session()
+_SESSION.headers.update({'User-Agent': "trivialsec.com"})
+_SESSION.mount("http://", HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=0))
+_SESSION.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=0))
+
+
+# key=token or key="quoted-string", a quoted-string may contain escapes and commas
+_AUTH_PAIR_RE = re.compile(r'\s*([a-zA-Z0-9_\-]+)=(""|"(?:[^"\\]|\\.)*"|[a-zA-Z0-9_\-]+)\s*(,|\Z)')
+_BACKSLASH_ESC_RE = re.compile(r"\\.")
+_DEFAULT_PORT_RE = re.compile(r":(?:80|443)/")
 
 
 def parse_authorization_header(authorization_header: str) -> dict[str, str]:
-    auth_param_re = r'([a-zA-Z0-9_\-]+)=(([a-zA-Z0-9_\-]+)|("")|(".*[^\\]"))'
-    auth_param_re = re.compile(r"^\s*" + auth_param_re + r"\s*$")
-    unesc_quote_re = re.compile(r'(^")|([^\\]")')
     scheme, pairs_str = authorization_header.split(None, 1)
     parsed_header = {"scheme": scheme}
-    pairs = []
-    if pairs_str:
-        for pair in pairs_str.split(","):
-            if not pairs or auth_param_re.match(pairs[-1]):  # type: ignore
-                pairs.append(pair)
-            else:
-                pairs[-1] = pairs[-1] + "," + pair
-        if not auth_param_re.match(pairs[-1]):  # type: ignore
+    pos, separator = 0, ","
+    # single left to right scan, each match ends at a comma or the end
+    while separator:
+        match = _AUTH_PAIR_RE.match(pairs_str, pos)
+        if not match:
             raise ValueError("Malformed auth parameters")
-    for pair in pairs:
-        (key, value) = pair.strip().split("=", 1)
+        key, value, separator = match.groups()
         # For quoted strings, remove quotes and backslash-escapes.
         if value.startswith('"'):
-            value = value[1:-1]
-            if unesc_quote_re.search(value):
-                raise ValueError("Unescaped quote in quoted-string")
-            value = re.compile(r"\\.").sub(lambda m: m.group(0)[1], value)
+            value = _BACKSLASH_ESC_RE.sub(lambda m: m.group(0)[1], value[1:-1])
         parsed_header[key] = value
+        pos = match.end()
     return parsed_header
 
 
@@ -87,44 +96,21 @@ class HMAC:
     _not_before_seconds: int = JITTER_SECONDS
     _expire_after_seconds: int = JITTER_SECONDS
 
-    @property
-    def scheme(self) -> Union[str, None]:
-        return (
-            None
-            if not hasattr(self, "parsed_header")
-            else self.parsed_header.get("scheme")
-        )
-
-    @property
-    def id(self) -> Union[str, None]:
-        return (
-            None if not hasattr(self, "parsed_header") else self.parsed_header.get("id")
-        )
-
-    @property
-    def ts(self) -> Union[int, None]:
-        return None if not hasattr(self, "parsed_header") else int(self.parsed_header.get("ts"))  # type: ignore
-
-    @property
-    def mac(self) -> Union[str, None]:
-        return (
-            self.parsed_header.get("mac")
-            if hasattr(self, "parsed_header")
-            else None
-        )
-
-    @property
+    @cached_property
     def canonical_string(self) -> str:
-        parsed_url = urlparse(self.request_url)
-        port = 443 if parsed_url.port is None else parsed_url.port
+        port = 443 if self._parsed_url.port is None else self._parsed_url.port
         bits = [self.request_method.upper()]
         bits.extend(
-            (parsed_url.hostname.lower(), str(port), parsed_url.path, str(self.ts))
+            (self._parsed_url.hostname.lower(), str(port), self._parsed_url.path, str(self.ts))
         )
         if self.contents:
             bits.append(b64encode(self.contents.encode("utf8")).decode("utf8"))
         return "\n".join(bits)
 
+    @cached_property
+    def _canonical_bytes(self) -> bytes:
+        return self.canonical_string.encode("utf8")
+
     def __init__(
         self,
         authorization_header: str,
@@ -140,9 +126,10 @@ class HMAC:
         self.contents = raw_body
         self.request_method: str = method
         self.request_url: str = request_url
+        # resolved once, an unsupported algorithm falls back to the default
         self.algorithm: str = (
             algorithm
-            if self.supported_algorithms.get(algorithm)
+            if algorithm in self.supported_algorithms
             else self.default_algorithm
         )
         self._expire_after_seconds: int = expire_after_seconds
@@ -150,51 +137,39 @@ class HMAC:
         self.parsed_header: dict[str, str] = parse_authorization_header(
             authorization_header
         )
+        # parsed once, validate reads these repeatedly
+        self.scheme: Union[str, None] = self.parsed_header.get("scheme")
+        self.id: Union[str, None] = self.parsed_header.get("id")
+        ts = self.parsed_header.get("ts")
+        self.ts: Union[int, None] = None if ts is None else int(ts)
+        self.mac: Union[str, None] = self.parsed_header.get("mac")
+        self._parsed_url = urlparse(request_url)
 
     def is_valid_scheme(self) -> bool:
         return self.authorization_header.startswith("HMAC")
 
     def is_valid_timestamp(self) -> bool:
         # not_before prevents replay attacks
-        compare_date = datetime.fromtimestamp(float(self.ts), tz=timezone.utc)  # type: ignore
-        now = datetime.now(tz=timezone.utc)
-        not_before = now - timedelta(seconds=self._not_before_seconds)
-        expire_after = now + timedelta(seconds=self._expire_after_seconds)
+        now = time.time()
+        not_before = now - self._not_before_seconds
         # expire_after can assist with support for offline/aeroplane mode
-        if compare_date < not_before or compare_date > expire_after:
+        expire_after = now + self._expire_after_seconds
+        if not_before <= self.ts <= expire_after:  # type: ignore
+            return True
+        if logger.isEnabledFor(logging.INFO):
+            now_date = datetime.fromtimestamp(now, tz=timezone.utc)
+            compare_date = datetime.fromtimestamp(self.ts, tz=timezone.utc)  # type: ignore
+            not_before_date = datetime.fromtimestamp(not_before, tz=timezone.utc)
+            expire_after_date = datetime.fromtimestamp(expire_after, tz=timezone.utc)
             logger.info(
-                f"now {now} compare_date {compare_date} not_before {not_before} expire_after {expire_after}"
+                f"now {now_date} compare_date {compare_date} "
+                f"not_before {not_before_date} expire_after {expire_after_date}"
             )
             logger.info(
-                f"compare_date < not_before {compare_date < not_before} compare_date > expire_after {compare_date > expire_after}"
+                f"compare_date < not_before {self.ts < not_before} "
+                f"compare_date > expire_after {self.ts > expire_after}"
             )
-            return False
-        return True
-
-    @staticmethod
-    def _compare(*values):
-        """
-        _compare() takes two or more str or byte-like inputs and compares
-        each to return True if they match or False if there is any mismatch
-        """
-        # In Python 3, if we have a bytes object, iterating it will already get the integer value
-        def chk_bytes(val):
-            return ord(
-                val if isinstance(val, (bytes, bytearray)) else val.encode("utf8")
-            )
-
-        result = 0
-        for index, this in enumerate(values):
-            if index == 0:  # first index has nothing to compare
-                continue
-            # use the index variable i to locate prev
-            prev = values[index - 1]
-            # Constant time string comparison, mitigates side channel attacks.
-            if len(prev) != len(this):
-                return False
-            for _x, _y in zip(chk_bytes(prev), chk_bytes(this)):  # type: ignore
-                result |= _x ^ _y
-        return result == 0
+        return False
 
     def validate(self, secret_key: str):
         if not self.is_valid_scheme():
@@ -205,15 +180,12 @@ class HMAC:
         if not self.is_valid_timestamp():
             logger.error(f"jitter detected {self.ts}")
             return False
-        if not self.supported_algorithms.get(self.algorithm):  # type: ignore
-            logger.error(f"algorithm {self.algorithm} is not supported")
-            return False
 
-        digestmod = self.supported_algorithms.get(self.algorithm, self.default_algorithm)  # type: ignore
         # Sign HMAC using server-side secret (not provided by client)
-        digest = hmac.new(
-            secret_key.encode("utf8"), self.canonical_string.encode("utf8"), digestmod
-        ).hexdigest()  # type: ignore
+        # hmac.digest takes the OpenSSL one-shot path for a named algorithm
+        digest = hmac.digest(
+            secret_key.encode("utf8"), self._canonical_bytes, self.algorithm
+        ).hex()
         self.server_mac = digest
         # Compare server-side HMAC with client provided HMAC
         if invalid := not hmac.compare_digest(digest, self.mac):  # type: ignore
@@ -226,7 +198,7 @@ class HMAC:
 class JSONEncoder(json.JSONEncoder):
     def default(self, o):
         if isinstance(o, datetime):
-            return o.replace(microsecond=0).isoformat()
+            return o.isoformat()
         if isinstance(
             o,
             (
@@ -246,14 +218,36 @@ class JSONEncoder(json.JSONEncoder):
         ):
             return str(o)
         if hasattr(o, "dict"):
-            return json.dumps(o.dict(), cls=JSONEncoder)
+            return o.dict()
 
         return super().default(o)
 
 
+def _orjson_default(o):
+    # orjson handles datetime, str and int subclasses natively
+    if isinstance(o, (PositiveInt, PositiveFloat)):
+        return int(o)
+    if isinstance(o, (IPv4Address, IPv6Address, IPv4Network, IPv6Network)):
+        return str(o)
+    if hasattr(o, "dict"):
+        return o.dict()
+    raise TypeError(f"Type is not JSON serializable: {type(o).__name__}")
+
+
+def json_encode(obj: Any) -> bytes:
+    return orjson.dumps(obj, default=_orjson_default)
+
+
+def json_dumps(obj: Any) -> str:
+    return json_encode(obj).decode("utf8")
+
+
+_BEACON_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="beacon")
+
+
 def _request_task(url, body, headers):
     with contextlib.suppress(requests.exceptions.ConnectionError):
-        requests.post(url, data=json.dumps(body, cls=JSONEncoder), headers=headers, timeout=(15, 30))
+        requests.post(url, data=json_dumps(body), headers=headers, timeout=(15, 30))
 
 
 def post_beacon(url: HttpUrl, body: dict, headers: dict = None):
@@ -264,66 +258,88 @@ def post_beacon(url: HttpUrl, body: dict, headers: dict = None):
     """
     if headers is None:
         headers = {"Content-Type": "application/json"}
-    threading.Thread(target=_request_task, args=(url, body, headers)).start()
+    _BEACON_POOL.submit(_request_task, url, body, headers)
 
 
 
 @retry((SocketError), tries=3, delay=1.5, backoff=1)
-def download_file(remote_file: str, temp_dir: str = CACHE_DIR) -> Path:
-    session = requests.Session()
-    remote_file = remote_file.replace(":80/", "/").replace(":443/", "/")
+def download_file(remote_file: str, temp_dir: str = CACHE_DIR) -> tuple[Union[Path, None], bool]:
+    """
+    returns the local path and whether the content changed since the
+    last download, cached content needs no re-processing
+    """
+    session = _SESSION
+    remote_file = _DEFAULT_PORT_RE.sub("/", remote_file)
     logger.info(f"[bold]Downloading[/bold] {remote_file}")
-    resp = session.get(
+    default_path = f"{temp_dir}/{urlsafe_b64encode(remote_file.encode('ascii')).decode('utf8').strip('=')}.txt"
+    headers = {}
+    # conditional GET, the server answers 304 without a body when unchanged
+    with contextlib.suppress(FileNotFoundError):
+        headers['If-Modified-Since'] = formatdate(path.getmtime(default_path), usegmt=True)
+        headers['If-None-Match'] = Path(f'{default_path}.etag').read_text(encoding='utf8')
+    # stream so the body is only read when the cached copy is stale
+    with session.get(
         remote_file,
         verify=remote_file.startswith('https'),
         allow_redirects=True,
         timeout=30,
-        headers={'User-Agent': "trivialsec.com"}
-    )
-    if not str(resp.status_code).startswith('2'):
-        if resp.status_code == 403:
-            logger.warning(f"Forbidden {remote_file}")
-        elif resp.status_code == 404:
-            logger.warning(f"Not Found {remote_file}")
-            return
-        else:
-            logger.error(f"Unexpected HTTP response code {resp.status_code} for URL {remote_file}")
-            return
-
-    file_size = int(resp.headers.get('Content-Length', 0))
-    dest_file = None
-    if 'Content-disposition' in resp.headers:
-        dest_file = resp.headers['Content-disposition'].replace('attachment;filename=', '').replace('attachment; filename=', '').replace('"', '', 2)
-    if not dest_file:
-        dest_file = urlsafe_b64encode(remote_file.encode('ascii')).decode('utf8').strip('=') + '.txt'
-
-    temp_path = f'{temp_dir}/{dest_file}'
-    logger.debug(f"[bold]temp_path[/bold] {temp_path}")
-    etag_path = f'{temp_path}.etag'
-    if file_size > 0 and path.exists(temp_path):
-        local_size = 0
+        headers=headers,
+        stream=True,
+    ) as resp:
+        if resp.status_code == 304:
+            logger.info(f"[bold]Not Modified[/bold] {default_path}")
+            return Path(default_path), False
+        if not str(resp.status_code).startswith('2'):
+            if resp.status_code == 403:
+                logger.warning(f"Forbidden {remote_file}")
+            elif resp.status_code == 404:
+                logger.warning(f"Not Found {remote_file}")
+                return None, False
+            else:
+                logger.error(f"Unexpected HTTP response code {resp.status_code} for URL {remote_file}")
+                return None, False
+
+        file_size = int(resp.headers.get('Content-Length', 0))
+        dest_file = None
+        if 'Content-disposition' in resp.headers:
+            dest_file = resp.headers['Content-disposition'].replace('attachment;filename=', '').replace('attachment; filename=', '').replace('"', '', 2)
+        temp_path = f'{temp_dir}/{dest_file}' if dest_file else default_path
+        logger.debug(f"[bold]temp_path[/bold] {temp_path}")
+        etag_path = f'{temp_path}.etag'
+        if file_size > 0:
+            try:
+                local_size = path.getsize(temp_path)
+            except FileNotFoundError:
+                local_size = 0
+            if local_size == file_size:
+                logger.info(f"[bold]Not Modified[/bold] {temp_path}")
+                return Path(temp_path), False
+
+        etag = resp.headers.get('ETag')
+        if etag:
+            try:
+                local_etag = Path(etag_path).read_text(encoding='utf8')
+            except FileNotFoundError:
+                local_etag = None
+            if local_etag == etag:
+                logger.info(f"[bold]Cached[/bold] {temp_path}")
+                return Path(temp_path), False
+
+        # copy raw bytes to disk, blocklists need no charset decoding
+        # into a .part file so a dropped connection never leaves a truncated cache
+        part_path = f'{temp_path}.part'
+        resp.raw.decode_content = True
         try:
-            local_size = path.getsize(temp_path)
-        except OSError as err:
-            if err.errno != errno.ENOENT:
-                raise
-        if local_size == file_size:
-            logger.info(f"[bold]Not Modified[/bold] {temp_path}")
-            return Path(temp_path)
-
-    etag = resp.headers.get('ETag')
-    if etag:
-        local_etag = None
-        if path.exists(etag_path):
-            local_etag = Path(etag_path).read_text(encoding='utf8')
-        if local_etag == etag:
-            logger.info(f"[bold]Cached[/bold] {temp_path}")
-            return Path(temp_path)
-
-    handle = Path(temp_path)
-    handle.write_text(resp.text, encoding='utf8')
+            with open(part_path, 'wb') as handle:
+                shutil.copyfileobj(resp.raw, handle, length=1 << 16)
+            replace(part_path, temp_path)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                remove(part_path)
+            raise
+
     if etag:
         logger.debug(f"[bold]etag[/bold] {etag}")
         Path(etag_path).write_text(etag, encoding='utf8')
 
-    return Path(temp_path)
+    return Path(temp_path), True
@@ -1,9 +1,9 @@
-import json
 from ipaddress import IPv4Address, IPv6Address, IPv4Network, IPv6Network
 from abc import ABCMeta, abstractmethod
 from typing import Union, Any, Optional
 from datetime import datetime, timezone
 
+import orjson
 from pydantic import (
     BaseModel,
     AnyHttpUrl,
@@ -65,10 +65,10 @@ class FeedState(BaseModel):
     def object_key(self):
         return f"{internals.APP_ENV}/feeds/{self.source}/{self.feed_name}/state.json"
 
-    def exit(self, record: str) -> FeedStateItem:
+    def exit(self, record: str, exited_at: Optional[datetime] = None) -> FeedStateItem:
         if item := self.records.get(record):
             item.current = False
-            item.exits.append(datetime.now(timezone.utc))
+            item.exits.append(exited_at or datetime.now(timezone.utc).replace(microsecond=0))
             self.records[record] = item
 
     def load(self) -> "FeedState":
@@ -77,17 +77,38 @@ class FeedState(BaseModel):
             internals.logger.warning(f"Missing state {self.object_key}")
             return
         try:
-            data = json.loads(raw)
-        except json.decoder.JSONDecodeError as err:
+            data = orjson.loads(raw)
+        except orjson.JSONDecodeError as err:
             internals.logger.debug(err, exc_info=True)
             return
         if not data or not isinstance(data, dict):
             internals.logger.warning(f"Missing state {self.object_key}")
             return
-        super().__init__(**data)
+        # state is only written by save(), skip the pydantic validation of every record
+        records = {
+            key: FeedStateItem.construct(
+                **{
+                    **record,
+                    "first_seen": datetime.fromisoformat(record["first_seen"]),
+                    "entrances": [datetime.fromisoformat(value) for value in record["entrances"]],
+                    "exits": [datetime.fromisoformat(value) for value in record["exits"]],
+                }
+            )
+            for key, record in (data.get("records") or {}).items()
+        }
+        last_checked = data.get("last_checked")
+        state = FeedState.construct(
+            **{
+                **data,
+                "records": records,
+                "last_checked": datetime.fromisoformat(last_checked) if last_checked else None,
+            }
+        )
+        self.__dict__.update(state.__dict__)
+        self.__fields_set__.update(state.__fields_set__)
         return self
 
     def save(self) -> bool:
         return services.aws.store_s3(
-            self.object_key, json.dumps(self.dict(), default=str)
+            self.object_key, internals.json_encode(self.dict())
         )
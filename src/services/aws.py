@@ -1,6 +1,8 @@
 import json
+import threading
 from os import getenv
 from enum import Enum
+from functools import lru_cache
 from hashlib import sha256
 from typing import Any, Union
 
@@ -17,9 +19,15 @@ from botocore.exceptions import (
 import internals
 
 STORE_BUCKET = getenv("STORE_BUCKET", "trivialscan-dashboard-store")
-ssm_client = boto3.client(service_name="ssm")
 s3_client = boto3.client(service_name="s3")
 sqs_client = boto3.client(service_name="sqs")
+_queue_urls: dict[str, str] = {}
+
+
+@lru_cache(maxsize=None)
+def _ssm_client():
+    # SSM is not used on the feed processing path, skip it at cold start
+    return boto3.client(service_name="ssm")
 
 
 class StorageClass(str, Enum):
@@ -68,7 +76,7 @@ def object_exists(file_path: str, bucket_name: str = STORE_BUCKET, **kwargs):
 def get_ssm(parameter: str, default: Any = None, **kwargs) -> Any:
     internals.logger.info(f"requesting secret {parameter}")
     try:
-        response = ssm_client.get_parameter(Name=parameter, **kwargs)
+        response = _ssm_client().get_parameter(Name=parameter, **kwargs)
         return (
             default
             if not isinstance(response, dict)
@@ -100,7 +108,7 @@ def get_ssm(parameter: str, default: Any = None, **kwargs) -> Any:
 def store_ssm(parameter: str, value: str, **kwargs) -> bool:
     internals.logger.info(f"storing secret {parameter}")
     try:
-        response = ssm_client.put_parameter(Name=parameter, Value=value, **kwargs)
+        response = _ssm_client().put_parameter(Name=parameter, Value=value, **kwargs)
         return (
             False
             if not isinstance(response, dict)
@@ -254,7 +262,7 @@ def delete_s3(path_key: str, bucket_name: str = STORE_BUCKET, **kwargs) -> bool:
 )
 def store_s3(
     path_key: str,
-    value: str,
+    value: Union[str, bytes],
     bucket_name: str = STORE_BUCKET,
     storage_class: StorageClass = StorageClass.STANDARD_IA,
     **kwargs,
@@ -368,3 +376,127 @@ def store_sqs(queue_name: str, message_body: str, deduplicate: bool = False, ded
         else:
             internals.logger.exception(err)
     return False
+
+
+@retry(
+    (
+        ConnectionClosedError,
+        ReadTimeoutError,
+        ConnectTimeoutError,
+        CapacityNotAvailableError,
+    ),
+    tries=3,
+    delay=1.5,
+    backoff=1,
+)
+def _queue_url(queue_name: str) -> Union[str, None]:
+    if queue_name not in _queue_urls:
+        _queue_urls[queue_name] = sqs_client.get_queue_url(QueueName=queue_name).get('QueueUrl')
+    return _queue_urls[queue_name]
+
+
+@retry(
+    (
+        ConnectionClosedError,
+        ReadTimeoutError,
+        ConnectTimeoutError,
+        CapacityNotAvailableError,
+    ),
+    tries=3,
+    delay=1.5,
+    backoff=1,
+)
+def _send_message_batch(queue_url: str, entries: list[dict]) -> list[dict]:
+    response = sqs_client.send_message_batch(QueueUrl=queue_url, Entries=entries)
+    if not isinstance(response, dict):
+        return entries
+    failed_ids = set()
+    for failed in response.get("Failed", []):
+        internals.logger.error(f"{failed.get('Code')}: {failed.get('Message')}")
+        failed_ids.add(failed["Id"])
+    return [entry for entry in entries if entry["Id"] in failed_ids]
+
+
+def store_sqs_batch(queue_name: str, message_bodies: list[str], deduplicate: bool = False, message_group_id: Union[str, None] = None, batch_size: int = 10) -> list[str]:
+    """
+    Sends messages using SendMessageBatch, up to 10 per request (the SQS limit)
+
+    params:
+    - queue_name: target SQS queue
+    - message_bodies: serialized messages to send
+    returns:
+    - message bodies that SQS reported as Failed
+    """
+    internals.logger.info(f"storing {queue_name} {len(message_bodies)} messages")
+    failed = []
+    if not message_bodies:
+        return failed
+    try:
+        queue_url = _queue_url(queue_name)
+        if not queue_url:
+            internals.logger.error(f"no queue with name {queue_name}")
+            return list(message_bodies)
+
+        for offset in range(0, len(message_bodies), batch_size):
+            entries = []
+            for index, message_body in enumerate(message_bodies[offset:offset + batch_size]):
+                entry: dict[str, Any] = {
+                    'Id': str(offset + index),
+                    'MessageBody': message_body,
+                }
+                if queue_name.endswith('.fifo'):
+                    deduplication_id = sha256(message_body.encode()).hexdigest() if deduplicate else None
+                    if deduplication_id:
+                        entry['MessageDeduplicationId'] = deduplication_id
+                    if group_id := message_group_id or deduplication_id:
+                        entry['MessageGroupId'] = group_id
+                entries.append(entry)
+            try:
+                failed.extend(entry['MessageBody'] for entry in _send_message_batch(queue_url, entries))
+            except ClientError as err:
+                if err.response["Error"]["Code"] == "BatchRequestTooLong":  # type: ignore
+                    internals.logger.error(f"BatchRequestTooLong: {err}")
+                elif err.response["Error"]["Code"] == "UnsupportedOperation":  # type: ignore
+                    internals.logger.error(f"UnsupportedOperation: {err}")
+                else:
+                    internals.logger.exception(err)
+                failed.extend(entry['MessageBody'] for entry in entries)
+    except ClientError as err:
+        internals.logger.exception(err)
+        return list(message_bodies)
+    return failed
+
+
+class SqsBuffer:
+    """
+    Accumulates messages from any number of producers (threads) and
+    sends them with SendMessageBatch whenever a full batch is ready
+    """
+    def __init__(self, queue_name: str, batch_size: int = 10):
+        self.queue_name = queue_name
+        self.batch_size = batch_size
+        self.entries: list[str] = []
+        self.queued = 0
+        self.failed: list[str] = []
+        self._lock = threading.Lock()
+
+    def add(self, message_body: str):
+        with self._lock:
+            self.entries.append(message_body)
+            if len(self.entries) < self.batch_size:
+                return
+            batch, self.entries = self.entries, []
+        self._send(batch)
+
+    def flush(self):
+        with self._lock:
+            batch, self.entries = self.entries, []
+        self._send(batch)
+
+    def _send(self, batch: list[str]):
+        if not batch:
+            return
+        failed = store_sqs_batch(self.queue_name, batch, batch_size=self.batch_size)
+        with self._lock:
+            self.queued += len(batch) - len(failed)
+            self.failed.extend(failed)